@@ -1,9 +1,14 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, UploadFile, File, Request, Response, BackgroundTasks
+from fastapi.responses import FileResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 import os
+import re
+import io
+import asyncio
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
@@ -12,6 +17,9 @@ import uuid
 from datetime import datetime, timezone
 import hashlib
 import secrets
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image, ImageOps
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -21,6 +29,17 @@ mongo_url = os.environ['MONGO_URL']
 client = AsyncIOMotorClient(mongo_url)
 db = client[os.environ['DB_NAME']]
 
+# Content-addressed photo store
+PHOTO_DIR = Path(os.environ.get('PHOTO_DIR', ROOT_DIR / 'photos'))
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_PHOTO_PIXELS = 25_000_000  # Bounds decode memory per pool worker
+THUMBNAIL_SIZES = {"small": 64, "medium": 256, "large": 1024}
+PHOTO_HASH_RE = re.compile(r'^[0-9a-f]{64}$')
+PHOTO_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Thumbnail generation is CPU bound, so it runs outside the event loop
+photo_pool: Optional[ProcessPoolExecutor] = None
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -49,6 +68,7 @@ class Member(BaseModel):
     occupation: Optional[str] = None
     contact: Optional[str] = None
     photo_url: Optional[str] = None
+    photo_hash: Optional[str] = None  # Key into the local photo store, see /photos/{hash}/{size}
     gender: Optional[str] = None
     additional_families: Optional[List[str]] = []  # For members who belong to multiple families
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -63,6 +83,9 @@ class MemberCreate(BaseModel):
     gender: Optional[str] = None
     additional_families: Optional[List[str]] = []
 
+class MemberUpdate(MemberCreate):
+    remove_photo: bool = False  # Clears the uploaded photo; uploads go through /members/{id}/photo
+
 class Relationship(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     member1_id: str
@@ -75,6 +98,15 @@ class RelationshipCreate(BaseModel):
     member2_id: str
     relationship_type: str
 
+class FamilyLink(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    family_a: str  # Always the lexically smaller family id of the pair
+    family_b: str
+    relationship_id: str
+    member1_id: str
+    member2_id: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 class AdminUser(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     username: str
@@ -117,6 +149,187 @@ def parse_from_mongo(item):
         item['created_at'] = datetime.fromisoformat(item['created_at'])
     return item
 
+# Relationship types that join two families together
+MARRIAGE_RELATIONSHIP_TYPES = {"spouse"}
+
+def member_family_ids(member: dict) -> set:
+    return {member["family_id"], *(member.get("additional_families") or [])}
+
+def family_pair(family_a: str, family_b: str):
+    return (family_a, family_b) if family_a <= family_b else (family_b, family_a)
+
+async def sync_family_links(relationship: dict):
+    # Bring the family-to-family edges for a single marriage relationship up to date.
+    # Upserts against the unique (relationship_id, family_a, family_b) index mean that
+    # concurrent runs never create duplicate rows. They do not serialise the runs, so
+    # two runs that read different member state can leave a stale edge behind until
+    # the relationship is synced again.
+    pairs = set()
+    if relationship["relationship_type"] in MARRIAGE_RELATIONSHIP_TYPES:
+        member1 = await db.members.find_one({"id": relationship["member1_id"]})
+        member2 = await db.members.find_one({"id": relationship["member2_id"]})
+        if member1 and member2:
+            pairs = {
+                family_pair(family1, family2)
+                for family1 in member_family_ids(member1)
+                for family2 in member_family_ids(member2)
+                if family1 != family2
+            }
+
+    stale_query = {"relationship_id": relationship["id"]}
+    if pairs:
+        stale_query["$nor"] = [{"family_a": family_a, "family_b": family_b} for family_a, family_b in pairs]
+    await db.family_links.delete_many(stale_query)
+
+    for family_a, family_b in pairs:
+        link = prepare_for_mongo(FamilyLink(
+            family_a=family_a,
+            family_b=family_b,
+            relationship_id=relationship["id"],
+            member1_id=relationship["member1_id"],
+            member2_id=relationship["member2_id"]
+        ).dict())
+        key = {"relationship_id": relationship["id"], "family_a": family_a, "family_b": family_b}
+        try:
+            await db.family_links.update_one(
+                key,
+                {"$setOnInsert": {k: v for k, v in link.items() if k not in key}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            # Another writer inserted the same edge first
+            pass
+
+async def sync_member_family_links(member_id: str):
+    # A member's families changed, so refresh every marriage they are part of
+    relationships = db.relationships.find({
+        "$or": [{"member1_id": member_id}, {"member2_id": member_id}],
+        "relationship_type": {"$in": list(MARRIAGE_RELATIONSHIP_TYPES)}
+    })
+    async for rel in relationships:
+        await sync_family_links(rel)
+
+def photo_path(photo_hash: str) -> Path:
+    return PHOTO_DIR / photo_hash[:2] / photo_hash
+
+def thumbnail_path(photo_hash: str, size: str) -> Path:
+    return photo_path(photo_hash) / f"{size}.jpg"
+
+def write_atomic(path: Path, data: bytes):
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+class PhotoTooLarge(Exception):
+    pass
+
+class PhotoDecodeError(Exception):
+    pass
+
+# What Pillow raises for bad image data. Decoding always happens from memory,
+# so an OSError here comes from the decoder rather than from disk I/O.
+IMAGE_DECODE_ERRORS = (OSError, SyntaxError, ValueError, Image.DecompressionBombError)
+
+def validate_image(data: bytes):
+    # Runs in the photo pool; raises PhotoTooLarge or an IMAGE_DECODE_ERRORS error.
+    # The size is checked from the header before any pixels are decoded, and
+    # verify() only checks structure, so load() catches truncated pixel data.
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        if width * height > MAX_PHOTO_PIXELS:
+            raise PhotoTooLarge()
+        image.verify()
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+    return width, height
+
+def render_thumbnails(data: bytes, sizes: List[str]) -> dict:
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        rendered = {}
+        for size in sizes:
+            thumbnail = image.copy()
+            thumbnail.thumbnail((THUMBNAIL_SIZES[size], THUMBNAIL_SIZES[size]), Image.LANCZOS)
+            buffer = io.BytesIO()
+            thumbnail.save(buffer, "JPEG", quality=85, optimize=True, progressive=True)
+            rendered[size] = buffer.getvalue()
+        return rendered
+
+def generate_thumbnails(photo_hash: str, sizes: List[str]):
+    # Runs in the photo pool; renders the requested sizes from the stored original.
+    # Only a decode failure leaves the "failed" marker, so later requests skip the
+    # decode. I/O errors propagate unmarked and the next request retries.
+    sizes = [size for size in sizes if not thumbnail_path(photo_hash, size).exists()]
+    if not sizes:
+        return
+    data = (photo_path(photo_hash) / "original").read_bytes()
+    try:
+        rendered = render_thumbnails(data, sizes)
+    except IMAGE_DECODE_ERRORS as e:
+        (photo_path(photo_hash) / "failed").touch()
+        raise PhotoDecodeError(str(e)) from e
+    for size, thumbnail in rendered.items():
+        write_atomic(thumbnail_path(photo_hash, size), thumbnail)
+
+def read_file_range(path: Path, start: int, length: int) -> bytes:
+    with open(path, "rb") as f:
+        f.seek(start)
+        return f.read(length)
+
+def reset_photo_pool(broken_pool: ProcessPoolExecutor):
+    # A worker that dies (e.g. OOM killed) breaks the whole executor for good
+    global photo_pool
+    if photo_pool is broken_pool:
+        logger.error("Photo process pool broke, starting a new one")
+        photo_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        broken_pool.shutdown(wait=False)
+
+async def run_in_photo_pool(func, *args):
+    pool = photo_pool
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(pool, func, *args)
+    except BrokenProcessPool:
+        reset_photo_pool(pool)
+        raise
+
+async def build_thumbnails(photo_hash: str):
+    try:
+        await run_in_photo_pool(generate_thumbnails, photo_hash, list(THUMBNAIL_SIZES))
+    except Exception:
+        logger.exception("Thumbnail generation failed for photo %s", photo_hash)
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+def parse_range(range_header: str, file_size: int):
+    # Returns (start, end) for a single byte range, or None when the header should be
+    # ignored (malformed or multi-range) and the full file served instead.
+    # Raises RangeNotSatisfiable for well-formed ranges that fall outside the file.
+    match = re.fullmatch(r'bytes=(\d*)-(\d*)', range_header.strip())
+    if not match or match.group(1) == match.group(2) == '':
+        return None
+    if match.group(1) == '':
+        # Suffix range: the last N bytes
+        suffix_length = int(match.group(2))
+        if suffix_length == 0 or file_size == 0:
+            raise RangeNotSatisfiable()
+        return max(file_size - suffix_length, 0), file_size - 1
+    start = int(match.group(1))
+    if match.group(2) and int(match.group(2)) < start:
+        return None
+    if start >= file_size:
+        raise RangeNotSatisfiable()
+    end = min(int(match.group(2)), file_size - 1) if match.group(2) else file_size - 1
+    return start, end
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
 # Basic routes
 @api_router.get("/")
 async def root():
@@ -150,9 +363,20 @@ async def get_members():
 
 @api_router.get("/families/{family_id}/members", response_model=List[Member])
 async def get_family_members(family_id: str):
-    members = await db.members.find({"family_id": family_id}).to_list(1000)
+    members = await db.members.find({
+        "$or": [{"family_id": family_id}, {"additional_families": family_id}]
+    }).to_list(1000)
     return [Member(**parse_from_mongo(member)) for member in members]
 
+@api_router.get("/families/{family_a}/links/{family_b}", response_model=List[FamilyLink])
+async def get_family_links(family_a: str, family_b: str):
+    for family_id in (family_a, family_b):
+        if not await db.families.find_one({"id": family_id}):
+            raise HTTPException(status_code=404, detail="Family not found")
+    low, high = family_pair(family_a, family_b)
+    links = await db.family_links.find({"family_a": low, "family_b": high}).to_list(1000)
+    return [FamilyLink(**parse_from_mongo(link)) for link in links]
+
 @api_router.post("/members", response_model=Member)
 async def create_member(member_data: MemberCreate, admin: dict = Depends(verify_admin)):
     member = Member(**member_data.dict())
@@ -161,23 +385,103 @@ async def create_member(member_data: MemberCreate, admin: dict = Depends(verify_
     return member
 
 @api_router.put("/members/{member_id}", response_model=Member)
-async def update_member(member_id: str, member_data: MemberCreate, admin: dict = Depends(verify_admin)):
-    member = Member(id=member_id, **member_data.dict())
+async def update_member(member_id: str, member_data: MemberUpdate, admin: dict = Depends(verify_admin)):
+    existing = await db.members.find_one({"id": member_id})
+    if not existing:
+        raise HTTPException(status_code=404, detail="Member not found")
+    # photo_hash is only set through the photo upload route, so carry it over
+    photo_hash = None if member_data.remove_photo else existing.get("photo_hash")
+    member = Member(id=member_id, photo_hash=photo_hash, **member_data.dict(exclude={"remove_photo"}))
     member_dict = prepare_for_mongo(member.dict())
     result = await db.members.replace_one({"id": member_id}, member_dict)
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Member not found")
+    await sync_member_family_links(member_id)
     return member
 
 @api_router.delete("/members/{member_id}")
 async def delete_member(member_id: str, admin: dict = Depends(verify_admin)):
     # Also delete relationships involving this member
     await db.relationships.delete_many({"$or": [{"member1_id": member_id}, {"member2_id": member_id}]})
+    await db.family_links.delete_many({"$or": [{"member1_id": member_id}, {"member2_id": member_id}]})
     result = await db.members.delete_one({"id": member_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Member not found")
     return {"message": "Member deleted successfully"}
 
+@api_router.post("/members/{member_id}/photo", response_model=Member)
+async def upload_member_photo(member_id: str, background_tasks: BackgroundTasks, photo: UploadFile = File(...), admin: dict = Depends(verify_admin)):
+    member = await db.members.find_one({"id": member_id})
+    if not member:
+        raise HTTPException(status_code=404, detail="Member not found")
+
+    data = await photo.read(MAX_PHOTO_BYTES + 1)
+    if len(data) > MAX_PHOTO_BYTES:
+        raise HTTPException(status_code=413, detail="Photo is too large")
+    try:
+        await run_in_photo_pool(validate_image, data)
+    except BrokenProcessPool:
+        raise HTTPException(status_code=503, detail="Photo processing is temporarily unavailable")
+    except (PhotoTooLarge, Image.DecompressionBombError):
+        raise HTTPException(status_code=413, detail="Photo dimensions are too large")
+    except IMAGE_DECODE_ERRORS:
+        raise HTTPException(status_code=400, detail="Uploaded file is not a valid image")
+
+    # Identical uploads share one stored copy and one set of thumbnails
+    photo_hash = hashlib.sha256(data).hexdigest()
+    original = photo_path(photo_hash) / "original"
+    if not await asyncio.to_thread(original.exists):
+        await asyncio.to_thread(original.parent.mkdir, parents=True, exist_ok=True)
+        await asyncio.to_thread(write_atomic, original, data)
+    # The upload just decoded cleanly, so give an earlier failed render another try
+    await asyncio.to_thread((original.parent / "failed").unlink, missing_ok=True)
+    background_tasks.add_task(build_thumbnails, photo_hash)
+
+    update = {"photo_hash": photo_hash}
+    await db.members.update_one({"id": member_id}, {"$set": update})
+    member.update(update)
+    return Member(**parse_from_mongo(member))
+
+@api_router.get("/photos/{photo_hash}/{size}")
+async def get_photo(photo_hash: str, size: str, request: Request):
+    if not PHOTO_HASH_RE.match(photo_hash) or size not in THUMBNAIL_SIZES:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    path = thumbnail_path(photo_hash, size)
+    if not await asyncio.to_thread(path.exists):
+        photo_dir = photo_path(photo_hash)
+        if not await asyncio.to_thread((photo_dir / "original").exists):
+            raise HTTPException(status_code=404, detail="Photo not found")
+        if await asyncio.to_thread((photo_dir / "failed").exists):
+            raise HTTPException(status_code=404, detail="Photo could not be processed")
+        # Upload's background job has not finished yet, render this size now
+        try:
+            await run_in_photo_pool(generate_thumbnails, photo_hash, [size])
+        except BrokenProcessPool:
+            raise HTTPException(status_code=503, detail="Photo processing is temporarily unavailable")
+        except PhotoDecodeError:
+            logger.exception("Thumbnail generation failed for photo %s", photo_hash)
+            raise HTTPException(status_code=404, detail="Photo could not be processed")
+
+    etag = f'"{photo_hash}-{size}"'
+    headers = {"Cache-Control": PHOTO_CACHE_CONTROL, "ETag": etag, "Accept-Ranges": "bytes"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if range_header:
+        file_size = (await asyncio.to_thread(path.stat)).st_size
+        try:
+            byte_range = parse_range(range_header, file_size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{file_size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            content = await asyncio.to_thread(read_file_range, path, start, end - start + 1)
+            headers["Content-Range"] = f"bytes {start}-{end}/{file_size}"
+            return Response(content=content, status_code=206, media_type="image/jpeg", headers=headers)
+
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
 # Relationship routes
 @api_router.get("/relationships", response_model=List[Relationship])
 async def get_relationships():
@@ -196,6 +500,7 @@ async def create_relationship(rel_data: RelationshipCreate, admin: dict = Depend
     relationship = Relationship(**rel_data.dict())
     rel_dict = prepare_for_mongo(relationship.dict())
     await db.relationships.insert_one(rel_dict)
+    await sync_family_links(rel_dict)
     return relationship
 
 @api_router.delete("/relationships/{relationship_id}")
@@ -203,6 +508,7 @@ async def delete_relationship(relationship_id: str, admin: dict = Depends(verify
     result = await db.relationships.delete_one({"id": relationship_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Relationship not found")
+    await db.family_links.delete_many({"relationship_id": relationship_id})
     return {"message": "Relationship deleted successfully"}
 
 # Search route
@@ -317,6 +623,7 @@ async def initialize_data():
         relationship = Relationship(**rel_data)
         rel_dict = prepare_for_mongo(relationship.dict())
         await db.relationships.insert_one(rel_dict)
+        await sync_family_links(rel_dict)
     
     return {"message": "Sample data initialized successfully"}
 
@@ -338,6 +645,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def start_photo_pool():
+    global photo_pool
+    PHOTO_DIR.mkdir(parents=True, exist_ok=True)
+    photo_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+
+@app.on_event("startup")
+async def create_indexes():
+    await db.members.create_index("family_id")
+    # Multikey index so family views can include members who married in
+    await db.members.create_index("additional_families")
+    await db.relationships.create_index("member1_id")
+    await db.relationships.create_index("member2_id")
+    await db.family_links.create_index([("family_a", 1), ("family_b", 1)])
+    await db.family_links.create_index(
+        [("relationship_id", 1), ("family_a", 1), ("family_b", 1)], unique=True
+    )
+
+    # Backfill the edge table once for databases created before it existed.
+    # The rebuild is idempotent, so workers racing on startup are harmless.
+    if not await db.migrations.find_one({"id": "family_links_backfill"}):
+        marriages = db.relationships.find({
+            "relationship_type": {"$in": list(MARRIAGE_RELATIONSHIP_TYPES)}
+        })
+        async for rel in marriages:
+            await sync_family_links(rel)
+        await db.migrations.update_one(
+            {"id": "family_links_backfill"},
+            {"$set": {"completed_at": datetime.now(timezone.utc).isoformat()}},
+            upsert=True
+        )
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    client.close()
+
+@app.on_event("shutdown")
+async def shutdown_photo_pool():
+    if photo_pool:
+        photo_pool.shutdown()
\ No newline at end of file
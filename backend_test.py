@@ -2,7 +2,26 @@ import requests
 import sys
 import json
 import base64
+import struct
+import zlib
 from datetime import datetime
+from pathlib import Path
+
+def make_png(width, height, color=(200, 120, 40), rows=None, truncate=False):
+    """Build an RGB PNG in memory; rows limits the pixel data actually written and
+    truncate cuts the compressed stream while keeping every chunk checksum valid"""
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    raw = b"".join(b"\x00" + bytes(color) * width for _ in range(height if rows is None else rows))
+    pixels = zlib.compress(raw)
+    if truncate:
+        pixels = pixels[:len(pixels) // 2]
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", pixels)
+        + chunk(b"IEND", b"")
+    )
 
 class FamilyTreeAPITester:
     def __init__(self, base_url="https://github-changes.preview.emergentagent.com"):
@@ -55,6 +74,45 @@ class FamilyTreeAPITester:
             print(f"❌ Failed - Error: {str(e)}")
             return False, {}
 
+    def run_raw_test(self, name, method, endpoint, expected_status, headers=None, files=None):
+        """Run a single API test and return the raw response for header checks"""
+        url = f"{self.api_url}/{endpoint}"
+        test_headers = dict(self.auth_header or {})
+        if headers:
+            test_headers.update(headers)
+
+        self.tests_run += 1
+        print(f"\n🔍 Testing {name}...")
+        print(f"   URL: {url}")
+        
+        try:
+            if method == 'GET':
+                response = requests.get(url, headers=test_headers, timeout=30)
+            elif method == 'POST':
+                response = requests.post(url, files=files, headers=test_headers, timeout=30)
+
+            if response.status_code == expected_status:
+                self.tests_passed += 1
+                print(f"✅ Passed - Status: {response.status_code}")
+                return True, response
+            print(f"❌ Failed - Expected {expected_status}, got {response.status_code}")
+            print(f"   Response: {response.text[:200]}...")
+            return False, response
+
+        except Exception as e:
+            print(f"❌ Failed - Error: {str(e)}")
+            return False, None
+
+    def check(self, name, condition):
+        """Record a single assertion about an earlier response"""
+        self.tests_run += 1
+        if condition:
+            self.tests_passed += 1
+            print(f"✅ Passed - {name}")
+        else:
+            print(f"❌ Failed - {name}")
+        return condition
+
     def setup_admin_auth(self):
         """Setup admin authentication"""
         username = "admin"
@@ -230,6 +288,239 @@ class FamilyTreeAPITester:
                     200
                 )
 
+    def test_multi_family_membership(self):
+        """Test membership through additional_families and family links"""
+        print("\n" + "="*50)
+        print("TESTING MULTI-FAMILY MEMBERSHIP")
+        print("="*50)
+        
+        if not self.auth_header or len(self.family_ids) < 2:
+            print("   Skipping - needs admin auth and two families")
+            return
+        
+        family_a, family_b = self.family_ids[0], self.family_ids[1]
+        married_in = {
+            "family_id": family_a,
+            "name": "Married-in Test Member",
+            "gender": "महिला",
+            "additional_families": [family_b]
+        }
+        success, member = self.run_test("Create Married-in Member", "POST", "members", 200, data=married_in)
+        success2, spouse = self.run_test(
+            "Create Spouse Member",
+            "POST",
+            "members",
+            200,
+            data={"family_id": family_b, "name": "Spouse Test Member", "gender": "पुरुष"}
+        )
+        if not (success and success2):
+            return
+        success, family_b_members = self.run_test(
+            "Get Family Members Via additional_families",
+            "GET",
+            f"families/{family_b}/members",
+            200
+        )
+        if success:
+            self.check(
+                "Married-in member listed in second family",
+                member['id'] in [m['id'] for m in family_b_members]
+            )
+        
+        success, rel = self.run_test(
+            "Create Cross-family Marriage",
+            "POST",
+            "relationships",
+            200,
+            data={"member1_id": member['id'], "member2_id": spouse['id'], "relationship_type": "spouse"}
+        )
+        if not success:
+            return
+        
+        def check_links(label, expected):
+            for first, second in ((family_a, family_b), (family_b, family_a)):
+                ok, links = self.run_test(
+                    f"Get Family Links {label}",
+                    "GET",
+                    f"families/{first}/links/{second}",
+                    200
+                )
+                if ok:
+                    matching = [link for link in links if link['relationship_id'] == rel['id']]
+                    self.check(f"{label}: {expected} edge(s) for the marriage", len(matching) == expected)
+        
+        check_links("After Marriage", 1)
+        
+        # Moving the member wholly into the spouse's family removes the cross-family edge
+        self.run_test(
+            "Move Married-in Member",
+            "PUT",
+            f"members/{member['id']}",
+            200,
+            data={**married_in, "family_id": family_b, "additional_families": []}
+        )
+        check_links("After Member Update", 0)
+        
+        self.run_test("Restore Married-in Member", "PUT", f"members/{member['id']}", 200, data=married_in)
+        check_links("After Member Restore", 1)
+        
+        self.run_test("Delete Cross-family Marriage", "DELETE", f"relationships/{rel['id']}", 200)
+        check_links("After Relationship Delete", 0)
+        
+        for member_id in (member['id'], spouse['id']):
+            self.run_test("Delete Multi-family Test Member", "DELETE", f"members/{member_id}", 200)
+
+    def test_parse_range(self):
+        """Unit test the Range header parser used for photo serving"""
+        print("\n" + "="*50)
+        print("TESTING RANGE PARSING")
+        print("="*50)
+        
+        sys.path.insert(0, str(Path(__file__).parent / "backend"))
+        try:
+            from server import parse_range, RangeNotSatisfiable
+        except Exception as e:
+            print(f"   Skipping - backend not importable: {e}")
+            return
+        
+        def parsed(header, file_size=100):
+            try:
+                return parse_range(header, file_size)
+            except RangeNotSatisfiable:
+                return "unsatisfiable"
+        
+        cases = [
+            ("bytes=0-9", (0, 9)),
+            ("bytes=90-", (90, 99)),       # open-ended
+            ("bytes=-10", (90, 99)),       # suffix
+            ("bytes=-500", (0, 99)),       # suffix longer than the file
+            ("bytes=10-500", (10, 99)),    # end clamped to the file
+            ("bytes=100-", "unsatisfiable"),
+            ("bytes=100-200", "unsatisfiable"),
+            ("bytes=-0", "unsatisfiable"),
+            ("bytes=9-3", None),           # invalid, ignored
+            ("bytes=0-1,3-4", None),       # multi-range, ignored
+            ("bytes=-", None),
+            ("items=0-9", None),
+            ("garbage", None),
+        ]
+        for header, expected in cases:
+            result = parsed(header)
+            self.check(f"parse_range({header!r}) == {expected!r} (got {result!r})", result == expected)
+
+    def test_photo_endpoints(self):
+        """Test photo upload and thumbnail serving"""
+        print("\n" + "="*50)
+        print("TESTING PHOTO ENDPOINTS")
+        print("="*50)
+        
+        # Unknown photos should not be served
+        self.run_test("Get Missing Photo", "GET", f"photos/{'0' * 64}/small", 404)
+        
+        if not self.auth_header or not self.family_ids:
+            print("   Skipping uploads - needs admin auth and a family")
+            return
+        
+        photo_member = {
+            "family_id": self.family_ids[0],
+            "name": "Photo Test Member",
+            "photo_url": "https://example.com/portrait.jpg"
+        }
+        success, member = self.run_test(
+            "Create Photo Test Member",
+            "POST",
+            "members",
+            200,
+            data=photo_member
+        )
+        if not success:
+            return
+        
+        def upload(name, data, expected_status):
+            return self.run_raw_test(
+                name,
+                "POST",
+                f"members/{member['id']}/photo",
+                expected_status,
+                files={"photo": ("photo.png", data, "image/png")}
+            )
+        
+        upload("Upload Non-image Photo", b"not an image", 400)
+        upload("Upload Truncated Photo", make_png(64, 64, truncate=True), 400)
+        upload("Upload Oversized Photo", make_png(6000, 6000, rows=1), 413)
+        
+        success, response = upload("Upload Photo", make_png(300, 200), 200)
+        photo_hash = response.json().get("photo_hash") if success else None
+        self.check("Upload sets photo_hash", bool(photo_hash))
+        if success:
+            self.check("Upload keeps photo_url", response.json().get("photo_url") == photo_member["photo_url"])
+        if photo_hash:
+            ok, stored = self.run_test("Get Members After Upload", "GET", "members", 200)
+            if ok:
+                self.check(
+                    "Stored member references the photo",
+                    any(m['id'] == member['id'] and m.get('photo_hash') == photo_hash for m in stored)
+                )
+            
+            # A full update must not drop the uploaded photo
+            ok, updated = self.run_test(
+                "Update Photo Test Member",
+                "PUT",
+                f"members/{member['id']}",
+                200,
+                data={**photo_member, "age": 40}
+            )
+            if ok:
+                self.check("Update keeps photo_hash", updated.get("photo_hash") == photo_hash)
+            
+            for size in ("small", "medium", "large"):
+                ok, response = self.run_raw_test(f"Get Photo {size}", "GET", f"photos/{photo_hash}/{size}", 200)
+                if ok:
+                    self.check(f"{size} is a JPEG", response.content[:2] == b"\xff\xd8")
+                    self.check(f"{size} is immutable", "immutable" in response.headers.get("Cache-Control", ""))
+                    self.check(f"{size} has an ETag", bool(response.headers.get("ETag")))
+            
+            endpoint = f"photos/{photo_hash}/small"
+            ok, response = self.run_raw_test("Get Photo For Headers", "GET", endpoint, 200)
+            if ok:
+                etag = response.headers["ETag"]
+                file_size = len(response.content)
+                self.run_raw_test("Photo If-None-Match", "GET", endpoint, 304, headers={"If-None-Match": etag})
+                self.run_raw_test(
+                    "Photo If-None-Match List",
+                    "GET",
+                    endpoint,
+                    304,
+                    headers={"If-None-Match": f'"other", {etag}'}
+                )
+                ok, partial = self.run_raw_test("Photo Range", "GET", endpoint, 206, headers={"Range": "bytes=0-9"})
+                if ok:
+                    self.check(
+                        "Range has Content-Range",
+                        partial.headers.get("Content-Range") == f"bytes 0-9/{file_size}"
+                    )
+                    self.check("Range returns requested bytes", partial.content == response.content[:10])
+                self.run_raw_test(
+                    "Photo Unsatisfiable Range",
+                    "GET",
+                    endpoint,
+                    416,
+                    headers={"Range": f"bytes={file_size}-"}
+                )
+                self.run_raw_test("Photo Multi-range Ignored", "GET", endpoint, 200, headers={"Range": "bytes=0-1,3-4"})
+            
+            ok, updated = self.run_test(
+                "Remove Member Photo",
+                "PUT",
+                f"members/{member['id']}",
+                200,
+                data={**photo_member, "remove_photo": True}
+            )
+            if ok:
+                self.check("Update with remove_photo clears photo_hash", updated.get("photo_hash") is None)
+        
+        self.run_test("Delete Photo Test Member", "DELETE", f"members/{member['id']}", 200)
+
     def test_search_functionality(self):
         """Test search functionality"""
         print("\n" + "="*50)
@@ -323,6 +614,9 @@ class FamilyTreeAPITester:
             self.test_family_endpoints()
             self.test_member_endpoints()
             self.test_relationship_endpoints()
+            self.test_multi_family_membership()
+            self.test_parse_range()
+            self.test_photo_endpoints()
             self.test_search_functionality()
             self.test_admin_endpoints()
             